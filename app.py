@@ -1,96 +1,79 @@
 # app.py
 
+import io
+import multiprocessing
+import os
 import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
 
+# Conversions already run in separate processes; keep OpenMP/BLAS in each
+# of them from starting a thread per core on top of that
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
 import streamlit as st
-from pdf2docx import Converter
-from docx import Document
 from deep_translator import GoogleTranslator
-from docx2pdf import convert as docx2pdf_convert
-
-
-def pdf_to_docx(
-    pdf_path: str,
-    docx_path: str,
-    start_page: int | None = None,
-    end_page: int | None = None,
-    multi_processing: bool = False,
-):
-    cv = Converter(pdf_path)
-
-    # pdf2docx uses zero-based page indices
-    convert_kwargs = {}
-    if start_page is not None:
-        convert_kwargs["start"] = max(start_page - 1, 0)
-    if end_page is not None:
-        # end is inclusive index in pdf2docx
-        convert_kwargs["end"] = max(end_page - 1, 0)
-
-    cv.convert(docx_path, multi_processing=multi_processing, **convert_kwargs)
-    cv.close()
-
-
-def translate_docx_by_paragraph(
-    input_path: str,
-    output_path: str,
-    source_lang: str = "auto",
-    target_lang: str = "zh-TW",
-):
-    """
-    Translate a .docx file paragraph-by-paragraph.
-    Paragraph-level formatting is preserved (e.g. headings),
-    but inline formatting (bold/italic on specific words) may be lost.
-    """
-    input_path = Path(input_path)
-    output_path = Path(output_path)
-
-    doc = Document(str(input_path))
-    translator = GoogleTranslator(source=source_lang, target=target_lang)
-
-    cache: dict[str, str] = {}
-
-    def safe_translate(text: str) -> str:
-        stripped = text.strip()
-        if not stripped:
-            return text  # keep empty/whitespace-only paragraphs as-is
-
-        if stripped in cache:
-            translated = cache[stripped]
-        else:
-            try:
-                translated = translator.translate(stripped)
-            except Exception as e:
-                # Fallback: keep original text if translation fails
-                print(f"Translation error for text: {stripped[:50]!r}... -> {e}")
-                return text
 
-            if not translated:
-                # If API returns None or empty, keep original
-                return text
+from core import (
+    TRANSLATE_MAX_WORKERS,
+    docx_to_pdf,
+    init_pymupdf,
+    pdf_to_docx,
+    release_memory,
+    temp_dir,
+    translate_docx,
+)
+
+
+@st.cache_resource
+def _conversion_pool() -> ProcessPoolExecutor:
+    # Shared by all sessions, so one slow PDF does not block other users
+    # and concurrent conversions run on separate cores. Workers come from a
+    # forkserver rather than being forked from the multi-threaded server.
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+
+@st.cache_resource
+def _translation_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=TRANSLATE_MAX_WORKERS, thread_name_prefix="translate"
+    )
+
 
-            cache[stripped] = translated
+@st.cache_resource
+def _warmup() -> bool:
+    # Pay PyMuPDF's one-time setup (and the first worker process start-up)
+    # once per server, instead of on a user's first conversion
+    init_pymupdf()
+    _conversion_pool().submit(init_pymupdf)
+    return True
 
-        # Preserve leading/trailing spaces
-        leading = len(text) - len(text.lstrip(" "))
-        trailing = len(text) - len(text.rstrip(" "))
-        return " " * leading + translated + " " * trailing
 
-    # Translate normal paragraphs
-    for para in doc.paragraphs:
-        para.text = safe_translate(para.text)
+@st.cache_data(ttl=24 * 3600)
+def _supported_languages() -> tuple[
+    dict[str, str], list[str], dict[str, str], dict[str, int]
+]:
+    # Load supported languages from deep-translator
+    langs_dict = GoogleTranslator().get_supported_languages(as_dict=True)
+    # langs_dict: {language_name: language_code}
+    language_names = sorted(langs_dict.keys())
 
-    # Translate paragraphs inside tables
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for para in cell.paragraphs:
-                    para.text = safe_translate(para.text)
+    # Reverse lookups, so reruns don't rescan the language list
+    code_to_name = {code.lower(): name for name, code in langs_dict.items()}
+    name_to_index = {name: i for i, name in enumerate(language_names)}
 
-    doc.save(str(output_path))
+    return langs_dict, language_names, code_to_name, name_to_index
 
 
 def main():
+    _warmup()
+
     st.title("PDF → DOCX Converter & Translator")
 
     st.markdown(
@@ -124,28 +107,34 @@ def main():
         )
         use_end = st.checkbox("Use end page", value=False)
 
-    multi_processing = st.checkbox(
-        "Enable multi-processing (faster on large PDFs)", value=False
-    )
+    # pdf2docx worker processes per conversion. Conversions from different
+    # users already run in parallel, so the default leaves cores for them.
+    max_workers = os.cpu_count() or 1
+    workers = 1
+    if max_workers > 1:
+        with st.expander("Advanced"):
+            workers = st.slider(
+                "Workers per conversion (faster on large PDFs)",
+                min_value=1,
+                max_value=max_workers,
+                value=min(4, max(max_workers // 2, 1)),
+                help=(
+                    "Number of CPU cores this conversion may use. "
+                    "1 disables pdf2docx's multi-processing."
+                ),
+            )
 
     # ---- Translation options ----
     st.subheader("Translation options")
 
     translate_enabled = st.checkbox("Translate output DOCX", value=False)
 
-    # Load supported languages from deep-translator
-    langs_dict = GoogleTranslator().get_supported_languages(as_dict=True)
-    # langs_dict: {language_name: language_code}
-    language_names = sorted(langs_dict.keys())
+    langs_dict, language_names, code_to_name, name_to_index = _supported_languages()
 
-    # Try to set default target to Traditional Chinese if available, else first language.
-    default_lang_name = None
-    for name, code in langs_dict.items():
-        if code.lower() in ("zh-tw", "zh-tw".lower()):
-            default_lang_name = name
-            break
-    if default_lang_name is None and language_names:
-        default_lang_name = language_names[0]
+    # Default target is Traditional Chinese if available, else first language.
+    default_lang_name = code_to_name.get(
+        "zh-tw", language_names[0] if language_names else None
+    )
 
     target_lang_name = None
     target_lang_code = None
@@ -154,7 +143,7 @@ def main():
         target_lang_name = st.selectbox(
             "Target language",
             language_names,
-            index=language_names.index(default_lang_name) if default_lang_name in language_names else 0,
+            index=name_to_index.get(default_lang_name, 0),
         )
         target_lang_code = langs_dict[target_lang_name]
 
@@ -193,78 +182,115 @@ def main():
             st.error("End page cannot be smaller than start page.")
             return
 
-        with st.spinner("Processing..."):
-            # 1. Write uploaded PDF to a temporary file
-            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_pdf:
-                tmp_pdf.write(uploaded_file.read())
-                tmp_pdf_path = tmp_pdf.name
-
-            # 2. Prepare temp output DOCX path for initial conversion
-            with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as tmp_docx:
-                tmp_docx_path = tmp_docx.name
-
-            # 3. PDF -> DOCX
-            pdf_to_docx(
-                pdf_path=tmp_pdf_path,
-                docx_path=tmp_docx_path,
-                start_page=sp,
-                end_page=ep,
-                multi_processing=multi_processing,
+        # Temp files are removed (and the download file closed) once the
+        # download button has been rendered, so nothing leaks across reruns
+        with ExitStack() as cleanup:
+            with st.spinner("Processing..."):
+                tmp_dir = temp_dir(uploaded_file.size)
+
+                # 1. Keep the uploaded PDF in memory, unless pdf2docx's
+                # worker processes need a file path to reopen it
+                if workers > 1:
+                    fd, pdf_file = tempfile.mkstemp(suffix=".pdf", dir=tmp_dir)
+                    cleanup.callback(os.unlink, pdf_file)
+                    # Unbuffered writes straight from the upload's memoryview,
+                    # independent of its read position
+                    upload_view = uploaded_file.getbuffer()
+                    with os.fdopen(fd, "wb", buffering=0) as tmp_pdf:
+                        written = 0
+                        while written < len(upload_view):
+                            written += tmp_pdf.write(upload_view[written:])
+                else:
+                    pdf_file = uploaded_file.getvalue()
+
+                # 2. PDF -> DOCX (in a worker process)
+                pool = _conversion_pool()
+                try:
+                    future = pool.submit(
+                        pdf_to_docx,
+                        pdf_file=pdf_file,
+                        start_page=sp,
+                        end_page=ep,
+                        cpu_count=workers,
+                    )
+                    docx_buf = io.BytesIO(future.result())
+                except BrokenProcessPool:
+                    # A worker died (crash or out-of-memory kill), which breaks
+                    # the shared pool; drop it so the next job gets a new one
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    _conversion_pool.clear()
+                    _warmup.clear()
+                    st.error(
+                        "The converter crashed while processing this PDF. "
+                        "Please try again, or convert a smaller page range."
+                    )
+                    return
+
+                # 3. Optional translation; the translated DOCX is written once,
+                # straight to wherever it is needed next
+                translate = None
+                if translate_enabled and target_lang_code is not None:
+                    translate = partial(
+                        translate_docx,
+                        source_lang="auto",
+                        target_lang=target_lang_code,
+                        executor=_translation_pool(),
+                    )
+
+                # 4. Optional conversion of translated DOCX to PDF
+                if translate_enabled and convert_translated_to_pdf:
+                    # LibreOffice only works with file paths
+                    with tempfile.NamedTemporaryFile(suffix=".docx", delete=False, dir=tmp_dir) as tmp_docx:
+                        cleanup.callback(os.unlink, tmp_docx.name)
+                        if translate is not None:
+                            translate(docx_buf, tmp_docx)
+                        else:
+                            tmp_docx.write(docx_buf.getbuffer())
+                    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False, dir=tmp_dir) as tmp_pdf_out:
+                        cleanup.callback(os.unlink, tmp_pdf_out.name)
+
+                    # DOCX -> PDF
+                    docx_to_pdf(tmp_docx.name, tmp_pdf_out.name)
+
+                    # Hand Streamlit the open file instead of reading it here
+                    download_data = cleanup.enter_context(open(tmp_pdf_out.name, "rb"))
+
+                    download_filename = Path(output_filename).with_suffix(".pdf").name
+                    mime = "application/pdf"
+                    label = "Download translated PDF"
+                else:
+                    # Default: just serve DOCX (translated if enabled, otherwise plain)
+                    if translate is not None:
+                        translated_buf = io.BytesIO()
+                        translate(docx_buf, translated_buf)
+                        docx_buf = translated_buf
+                    docx_buf.seek(0)
+                    download_data = docx_buf
+
+                    # If translated but not PDF, you may want to tag name, e.g. "_translated"
+                    if translate_enabled:
+                        base = Path(output_filename).stem
+                        download_filename = f"{base}_translated.docx"
+                    else:
+                        download_filename = output_filename
+
+                    mime = (
+                        "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+                    )
+                    label = "Download DOCX" if not translate_enabled else "Download translated DOCX"
+
+            st.success("Conversion complete.")
+            st.download_button(
+                label=label,
+                data=download_data,
+                file_name=download_filename,
+                mime=mime,
             )
 
-            final_docx_path = tmp_docx_path
-
-            # 4. Optional translation (DOCX -> translated DOCX)
-            if translate_enabled and target_lang_code is not None:
-                with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as tmp_translated_docx:
-                    tmp_translated_docx_path = tmp_translated_docx.name
-
-                translate_docx_by_paragraph(
-                    input_path=final_docx_path,
-                    output_path=tmp_translated_docx_path,
-                    source_lang="auto",
-                    target_lang=target_lang_code,
-                )
-                final_docx_path = tmp_translated_docx_path
-
-            # 5. Optional conversion of translated DOCX to PDF
-            if translate_enabled and convert_translated_to_pdf:
-                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_pdf_out:
-                    tmp_pdf_out_path = tmp_pdf_out.name
-
-                # DOCX -> PDF
-                docx2pdf_convert(final_docx_path, tmp_pdf_out_path)
-
-                with open(tmp_pdf_out_path, "rb") as f:
-                    file_bytes = f.read()
-
-                download_filename = Path(output_filename).with_suffix(".pdf").name
-                mime = "application/pdf"
-                label = "Download translated PDF"
-            else:
-                # Default: just serve DOCX (translated if enabled, otherwise plain)
-                with open(final_docx_path, "rb") as f:
-                    file_bytes = f.read()
-
-                # If translated but not PDF, you may want to tag name, e.g. "_translated"
-                if translate_enabled:
-                    base = Path(output_filename).stem
-                    download_filename = f"{base}_translated.docx"
-                else:
-                    download_filename = output_filename
-
-                mime = (
-                    "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                )
-                label = "Download DOCX" if not translate_enabled else "Download translated DOCX"
-
-        st.success("Conversion complete.")
-        st.download_button(
-            label=label,
-            data=file_bytes,
-            file_name=download_filename,
-            mime=mime,
-        )
+        # Streamlit keeps this process alive across reruns; drop the job's
+        # buffers now instead of letting them pile up
+        del pdf_file, docx_buf, download_data
+        release_memory()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,440 @@
+# core.py
+
+import ctypes
+import gc
+import hashlib
+import io
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
+from functools import partial
+from pathlib import Path
+from typing import IO
+
+import deep_translator.google
+import fitz
+import pdf2docx.converter
+import requests
+from pdf2docx import Converter
+from deep_translator import GoogleTranslator
+from deep_translator.exceptions import TooManyRequests
+from lxml import etree
+
+# Max number of texts handed to one translation worker task (each text is
+# still its own request, so small tasks keep all worker threads busy)
+TRANSLATE_BATCH_SIZE = 10
+# Number of batches translated concurrently
+TRANSLATE_MAX_WORKERS = 8
+# Attempts per batch when the API rate-limits us (exponential backoff)
+TRANSLATE_MAX_RETRIES = 4
+
+# Texts that translation would return unchanged: numbers, dates,
+# punctuation (page numbers, table figures) and bare URLs
+_NO_TRANSLATE_RE = re.compile(r"[\W\d_]+")
+_URL_RE = re.compile(r"(?:https?://|www\.)\S+")
+
+# WordprocessingML namespaces and the DOCX parts whose paragraphs get translated
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_NSMAP = {"w": _W_NS}
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+# Text nodes plus the tabs/line breaks between them, in document order
+_RUN_CONTENT_XPATH = (
+    "./w:r/*[self::w:t or self::w:tab or self::w:br or self::w:cr]"
+    " | ./w:hyperlink/w:r/*[self::w:t or self::w:tab or self::w:br or self::w:cr]"
+)
+_TRANSLATED_PARTS_RE = re.compile(r"word/(document|header\d*|footer\d*)\.xml")
+
+# Persistent translation cache shared across runs/sessions
+TRANSLATION_CACHE_PATH = Path(tempfile.gettempdir()) / "pdf2docx_xlate.sqlite"
+# Max number of keys per SELECT ... WHERE k IN (...) lookup
+CACHE_LOOKUP_BATCH_SIZE = 500
+
+# Memory-backed tmpfs for intermediate files, when available
+TMPFS_DIR = "/dev/shm"
+
+# Number of DOCX -> PDF conversions LibreOffice may run at once
+SOFFICE_INSTANCES = 2
+# Seconds before a single LibreOffice conversion is abandoned
+SOFFICE_TIMEOUT = 300
+
+
+# glibc's allocator, to hand freed heap memory back to the OS
+try:
+    _libc = ctypes.CDLL("libc.so.6")
+except OSError:  # not glibc (macOS, Windows, musl)
+    _libc = None
+
+
+def release_memory():
+    """Run a full garbage collection and return freed heap memory to the OS."""
+    gc.collect()
+    malloc_trim = getattr(_libc, "malloc_trim", None)
+    if malloc_trim is not None:
+        malloc_trim(0)
+
+
+def pdf_to_docx(
+    pdf_file: str | bytes,
+    start_page: int | None = None,
+    end_page: int | None = None,
+    cpu_count: int = 1,
+) -> bytes:
+    """
+    Convert a PDF, given as a file path or raw bytes, and return the DOCX bytes.
+    With cpu_count > 1, pdf2docx parses the pages in that many worker
+    processes; each worker reopens the PDF by name, so this needs a file path.
+    """
+    if isinstance(pdf_file, bytes):
+        cv = Converter(stream=pdf_file)
+    else:
+        cv = Converter(os.path.abspath(pdf_file))
+
+    # pdf2docx uses zero-based page indices
+    convert_kwargs = {}
+    if start_page is not None:
+        convert_kwargs["start"] = max(start_page - 1, 0)
+    if end_page is not None:
+        # end is inclusive index in pdf2docx
+        convert_kwargs["end"] = max(end_page - 1, 0)
+
+    docx_buf = io.BytesIO()
+    cwd = os.getcwd()
+    try:
+        # pdf2docx's multi-processing exchanges pages-<i>.json files through
+        # the current directory, so concurrent jobs in the shared pool would
+        # read each other's pages. Each pool worker runs one job at a time,
+        # so changing its cwd to a private directory is safe.
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            # pdf2docx's unsized Pool() forks one process per core but only
+            # gives work to cpu_count of them; don't fork the idle ones.
+            # Safe for the same reason as the chdir.
+            pdf2docx.converter.Pool = partial(
+                multiprocessing.Pool, processes=cpu_count
+            )
+            try:
+                cv.convert(
+                    docx_buf,
+                    multi_processing=cpu_count > 1,
+                    cpu_count=cpu_count,
+                    **convert_kwargs,
+                )
+            finally:
+                os.chdir(cwd)
+    finally:
+        # Don't keep PyMuPDF pages alive in this long-lived worker process
+        cv.close()
+        del cv
+        release_memory()
+    return docx_buf.getvalue()
+
+
+def _open_translation_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(TRANSLATION_CACHE_PATH, isolation_level=None)
+    # WAL lets concurrent Streamlit reruns read while another one writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS t(k TEXT PRIMARY KEY, v TEXT)")
+    return conn
+
+
+def _cache_key(source_lang: str, target_lang: str, text: str) -> str:
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return f"{source_lang}:{target_lang}:{digest}"
+
+
+# Per-thread translators and HTTP sessions, kept as long as the threads
+# that created them
+_thread_local = threading.local()
+
+
+def _thread_session() -> requests.Session:
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = _thread_local.session = requests.Session()
+    return session
+
+
+class _ThreadSessionRequests:
+    """
+    Stand-in for the requests module inside deep_translator.google: its
+    GoogleTranslator calls requests.get() for every text, opening a new
+    TCP/TLS connection each time. This routes each call through the calling
+    thread's own Session, so connections are kept alive between texts.
+    """
+
+    def get(self, *args, **kwargs):
+        return _thread_session().get(*args, **kwargs)
+
+
+deep_translator.google.requests = _ThreadSessionRequests()
+
+
+def _thread_translator(source_lang: str, target_lang: str) -> GoogleTranslator:
+    # GoogleTranslator mutates its request params on every call,
+    # so each worker thread keeps its own instances
+    translators = getattr(_thread_local, "translators", None)
+    if translators is None:
+        translators = _thread_local.translators = {}
+
+    key = (source_lang, target_lang)
+    if key not in translators:
+        translators[key] = GoogleTranslator(source=source_lang, target=target_lang)
+    return translators[key]
+
+
+def _translate_text(source_lang: str, target_lang: str, text: str) -> str | None:
+    """Translate one text, or return None if it fails."""
+    translator = _thread_translator(source_lang, target_lang)
+
+    for attempt in range(TRANSLATE_MAX_RETRIES):
+        try:
+            return translator.translate(text)
+        except TooManyRequests:
+            # Back off, but don't sleep after the last attempt
+            if attempt < TRANSLATE_MAX_RETRIES - 1:
+                time.sleep(2**attempt)
+        except Exception as e:
+            # Fallback: keep original text if translation fails
+            print(f"Translation error for text: {text[:50]!r}... -> {e}")
+            return None
+
+    print(f"Translation rate-limited for text: {text[:50]!r}...")
+    return None
+
+
+def _translate_batch(
+    source_lang: str, target_lang: str, batch: list[str]
+) -> list[str | None]:
+    """
+    Translate a batch of texts, one request per text, in a worker thread.
+    (deep_translator's translate_batch is the same loop, but one failing
+    text would discard the whole batch.)
+    """
+    return [_translate_text(source_lang, target_lang, text) for text in batch]
+
+
+def _needs_translation(text: str) -> bool:
+    return not (
+        len(text) < 2
+        or _NO_TRANSLATE_RE.fullmatch(text)
+        or _URL_RE.fullmatch(text)
+    )
+
+
+def _iter_text_segments(root):
+    """
+    Yield the <w:t> text nodes of each line or tab-separated piece of each
+    paragraph in a DOCX XML part. pdf2docx writes every PDF line as a
+    <w:br/>-separated piece of a paragraph and uses <w:tab/> for spacing,
+    so these pieces are translated separately and the breaks stay put.
+    """
+    w_t = f"{{{_W_NS}}}t"
+    for p in root.iter(f"{{{_W_NS}}}p"):
+        segment = []
+        for el in p.xpath(_RUN_CONTENT_XPATH, namespaces=_NSMAP):
+            if el.tag == w_t:
+                segment.append(el)
+            elif segment:
+                yield segment
+                segment = []
+        if segment:
+            yield segment
+
+
+def _translate_texts(
+    texts: list[str],
+    source_lang: str,
+    target_lang: str,
+    executor: ThreadPoolExecutor | None,
+) -> dict[str, str]:
+    """Return {text: translation} for the texts that could be translated."""
+    cache: dict[str, str] = {}
+    keys = {text: _cache_key(source_lang, target_lang, text) for text in texts}
+
+    with closing(_open_translation_cache()) as db:
+        # Look up previously translated texts
+        for i in range(0, len(texts), CACHE_LOOKUP_BATCH_SIZE):
+            chunk = texts[i : i + CACHE_LOOKUP_BATCH_SIZE]
+            chunk_keys = [keys[text] for text in chunk]
+            placeholders = ",".join("?" * len(chunk_keys))
+            rows = dict(
+                db.execute(
+                    f"SELECT k, v FROM t WHERE k IN ({placeholders})", chunk_keys
+                )
+            )
+            for text in chunk:
+                if keys[text] in rows:
+                    cache[text] = rows[keys[text]]
+
+        # Only translate cache misses
+        misses = [text for text in texts if text not in cache]
+        new_translations: dict[str, str] = {}
+
+        chunks = [
+            misses[i : i + TRANSLATE_BATCH_SIZE]
+            for i in range(0, len(misses), TRANSLATE_BATCH_SIZE)
+        ]
+        with ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(
+                    ThreadPoolExecutor(max_workers=TRANSLATE_MAX_WORKERS)
+                )
+            results = executor.map(
+                partial(_translate_batch, source_lang, target_lang), chunks
+            )
+            for chunk, translated_chunk in zip(chunks, results):
+                for stripped, translated in zip(chunk, translated_chunk):
+                    # If API returns None or empty, keep original
+                    if translated:
+                        new_translations[stripped] = translated
+
+        cache.update(new_translations)
+        if new_translations:
+            # One transaction, not one autocommit (and fsync) per row
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT OR REPLACE INTO t(k, v) VALUES (?, ?)",
+                [(keys[text], translated) for text, translated in new_translations.items()],
+            )
+            db.execute("COMMIT")
+
+    return cache
+
+
+def translate_docx(
+    input_docx: str | IO[bytes],
+    output_docx: str | IO[bytes],
+    source_lang: str = "auto",
+    target_lang: str = "zh-TW",
+    executor: ThreadPoolExecutor | None = None,
+):
+    """
+    Translate a .docx file line-by-line, working directly on the XML of the
+    document body, headers and footers.
+    Each paragraph is translated per piece of text between its line breaks
+    and tabs, which are kept in place. A translated piece goes into its first
+    text node and the other text nodes are emptied, so runs keep their
+    formatting (and images), but bold/italic on specific words follows the
+    piece's first run.
+
+    All unique texts are collected first and sent to the translator in
+    concurrent batches, instead of one request per line.
+    Translations are kept in an on-disk cache, so text seen in earlier
+    documents (headers, footers, boilerplate) is not translated again.
+
+    Pass a long-lived executor to reuse its threads' translators (and their
+    HTTP connections) across documents; otherwise a temporary one is used.
+    """
+    with zipfile.ZipFile(input_docx) as zin:
+        parts = {
+            name: etree.fromstring(zin.read(name))
+            for name in zin.namelist()
+            if _TRANSLATED_PARTS_RE.fullmatch(name)
+        }
+        segments = [
+            nodes for root in parts.values() for nodes in _iter_text_segments(root)
+        ]
+        segment_texts = ["".join(t.text or "" for t in nodes) for nodes in segments]
+
+        # Unique non-empty texts, in document order, so repeated headers,
+        # footers and table labels are only translated once
+        texts = [
+            text
+            for text in dict.fromkeys(text.strip() for text in segment_texts)
+            if _needs_translation(text)
+        ]
+        cache = _translate_texts(texts, source_lang, target_lang, executor)
+
+        for nodes, text in zip(segments, segment_texts):
+            stripped = text.strip()
+            if stripped not in cache:
+                continue  # empty/whitespace-only or untranslated: keep as-is
+
+            # Preserve leading/trailing spaces
+            leading = len(text) - len(text.lstrip(" "))
+            trailing = len(text) - len(text.rstrip(" "))
+            nodes[0].text = " " * leading + cache[stripped] + " " * trailing
+            nodes[0].set(_XML_SPACE, "preserve")
+            for node in nodes[1:]:
+                node.text = ""
+
+        with zipfile.ZipFile(output_docx, "w", zipfile.ZIP_DEFLATED) as zout:
+            for item in zin.infolist():
+                if item.filename in parts:
+                    data = etree.tostring(
+                        parts[item.filename],
+                        xml_declaration=True,
+                        encoding="UTF-8",
+                        standalone=True,
+                    )
+                else:
+                    data = zin.read(item)
+                zout.writestr(item, data)
+
+
+def temp_dir(size_hint: int) -> str | None:
+    """
+    Directory for a job's intermediate files: tmpfs if it is writable and has
+    room for a few copies of size_hint bytes, else None (default temp dir).
+    """
+    if not (os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK)):
+        return None
+    if shutil.disk_usage(TMPFS_DIR).free < 4 * size_hint:
+        return None
+    return TMPFS_DIR
+
+
+# soffice serializes all conversions that share a user profile, so each
+# concurrent conversion checks out its own profile directory. They are
+# created fresh and private (mode 0700) rather than at fixed /tmp paths
+# that other app instances or local users could share.
+_soffice_profiles: queue.Queue = queue.Queue()
+for _ in range(SOFFICE_INSTANCES):
+    _soffice_profiles.put(Path(tempfile.mkdtemp(prefix="lo_profile_")))
+
+
+def docx_to_pdf(docx_path: str, pdf_path: str):
+    """Convert a DOCX file to PDF with headless LibreOffice."""
+    profile = _soffice_profiles.get()
+    try:
+        with tempfile.TemporaryDirectory(dir=Path(pdf_path).parent) as out_dir:
+            try:
+                subprocess.run(
+                    [
+                        "soffice",
+                        f"-env:UserInstallation={profile.as_uri()}",
+                        "--headless",
+                        "--convert-to",
+                        "pdf",
+                        "--outdir",
+                        out_dir,
+                        docx_path,
+                    ],
+                    check=True,
+                    capture_output=True,
+                    timeout=SOFFICE_TIMEOUT,
+                )
+            except subprocess.TimeoutExpired:
+                # A leftover soffice.bin may keep using this profile; give
+                # the slot a fresh one instead
+                profile = Path(tempfile.mkdtemp(prefix="lo_profile_"))
+                raise
+            # soffice names the output after the input file
+            os.replace(Path(out_dir) / f"{Path(docx_path).stem}.pdf", pdf_path)
+    finally:
+        _soffice_profiles.put(profile)
+
+
+def init_pymupdf():
+    """Open and close an empty PDF to pay PyMuPDF's one-time setup cost."""
+    fitz.open().close()